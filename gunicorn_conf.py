@@ -0,0 +1,11 @@
+# Gunicorn configuration: gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# One process owns the GPU and the YOLO model; threads overlap the network I/O.
+# Don't enable preload_app: the batching and executor threads don't survive fork.
+workers = 1
+worker_class = "gthread"
+threads = 8
+timeout = 120